@@ -1,114 +1,309 @@
 #docAI.py
-from typing import Dict, List, Tuple
-import io, os, re
+from typing import DefaultDict, Dict, List, Mapping, Optional, Tuple
+from types import MappingProxyType
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import functools, hashlib, io, os, threading, uuid
 from PIL import Image
-from google.api_core.client_options import ClientOptions
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
+from google.api_core.retry import Retry, if_exception_type
 from google.cloud import documentai as docai
+from google.protobuf import field_mask_pb2
+from google.cloud.documentai_v1.services.document_processor_service.transports import DocumentProcessorServiceGrpcTransport
 
+# Catch dead connections during long calls and allow multi-MB documents back.
+_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.max_receive_message_length", 64 << 20),
+]
+
+_CACHE_SIZE = 256
+
+# Only what the parsers read; DocAI accepts top-level or pages.* paths here.
+_FIELD_MASK = field_mask_pb2.FieldMask(paths=["text", "entities", "pages.tables"])
+
+_ProcessRequest = docai.ProcessRequest
+_RawDocument = docai.RawDocument
+
+# Back off on quota errors (HTTP 429) and transient UNAVAILABLE instead of failing
+# the whole fan-out; passing retry= replaces the client default, so keep both.
+_RETRY = Retry(predicate=if_exception_type(ResourceExhausted, ServiceUnavailable),
+               initial=1.0, multiplier=2.0, maximum=47.0, timeout=300.0)
+
+# JPEG is far cheaper to encode than PNG's DEFLATE pass and much smaller on the wire.
+_ENCODERS = {
+    "image/jpeg": ("JPEG", {"quality": 90, "optimize": False}),
+    "image/png": ("PNG", {}),
+    "image/tiff": ("TIFF", {"compression": "raw"}),
+}
+
+@functools.lru_cache(maxsize=4096)
 def _norm(s: str) -> str:
-    s = (s or "").strip().lower().replace("_", " ")
-    return re.sub(r"\s+", " ", s)
+    # Entity types repeat heavily across entities and pages, so memoize.
+    return " ".join((s or "").lower().replace("_", " ").split())
+
+# ---- table walk (plain functions: no bound-method dispatch per cell) ----
+def _layout_text(text: str, layout) -> str:
+    try:
+        segs = layout.text_anchor.text_segments
+    except AttributeError:
+        return ""
+    n = len(segs)
+    if n == 0:
+        return ""
+    if n == 1:
+        seg = segs[0]
+        return text[int(seg.start_index or 0):int(seg.end_index or 0)].strip()
+    parts = []
+    for seg in segs:
+        start = int(seg.start_index or 0)
+        end = int(seg.end_index or 0)
+        if end > start:
+            parts.append(text[start:end])
+    return "".join(parts).strip()
+
+def _extract_tables(text: str, pages) -> List[Dict]:
+    tables_out: List[Dict] = []
+    for page in pages:
+        for t in page.tables:
+            headers: List[str] = []
+            if t.header_rows:
+                headers = [_layout_text(text, cell.layout) for cell in t.header_rows[0].cells]
+            rows = [[_layout_text(text, cell.layout) for cell in brow.cells] for brow in t.body_rows]
+            tables_out.append({"headers": headers, "rows": rows})
+    return tables_out
 
 class BaseDocAIParser:
     """Base class to call Document AI and extract key‑value fields and tables.
     Subclasses set a field map in __init__.
     """
-    norm_field_map: Dict[str, str] = {}
+    __slots__ = ("client", "name", "field_map", "norm_field_map", "max_side",
+                 "_mime", "_executor", "_cache", "_cache_lock", "_local")
 
-    def __init__(self, processor_id_env_var: str):
+    def __init__(self, processor_id_env_var: str, cache: bool = False):
+        self.field_map: Mapping[str, str] = MappingProxyType({})
+        self.norm_field_map: Mapping[str, str] = MappingProxyType({})
         project_id = os.getenv("DOC_AI_PROJECT_ID") or os.getenv("GOOGLE_CLOUD_PROJECT")
         location = os.getenv("DOC_AI_LOCATION", "us")
         processor_id = os.getenv(processor_id_env_var)
         if not processor_id:
             raise RuntimeError(f"Missing env var {processor_id_env_var}")
         endpoint = f"{location}-documentai.googleapis.com"
+        channel = DocumentProcessorServiceGrpcTransport.create_channel(endpoint, options=_CHANNEL_OPTIONS)
         self.client = docai.DocumentProcessorServiceClient(
-            client_options=ClientOptions(api_endpoint=endpoint)
+            transport=DocumentProcessorServiceGrpcTransport(host=endpoint, channel=channel)
         )
         self.name = f"projects/{project_id}/locations/{location}/processors/{processor_id}"
+        self._mime = "image/jpeg"
+        self.max_side = 2200
+        self._executor = None
+        # Optional LRU of (fields, tables) keyed by a hash of the encoded upload.
+        self._cache = OrderedDict() if cache else None
+        self._cache_lock = threading.Lock()
+        # One reusable ProcessRequest per thread; only the content changes per call.
+        self._local = threading.local()
+
+    def clear_cache(self):
+        if self._cache is not None:
+            with self._cache_lock:
+                self._cache.clear()
+
+    def set_encoding(self, mime: str):
+        """Upload encoding: image/jpeg (default), image/png or image/tiff (uncompressed)."""
+        if mime not in _ENCODERS:
+            raise ValueError(f"Unsupported encoding {mime}")
+        self._mime = mime
 
     # ---- helpers ----
-    def _img_bytes(self, image: Image.Image) -> bytes:
-        buf = io.BytesIO(); image.save(buf, format="PNG"); return buf.getvalue()
-
-    def _layout_text(self, document, layout) -> str:
-        if not layout or not getattr(layout, "text_anchor", None):
-            return ""
-        text = document.text or ""
-        parts = []
-        segs = getattr(layout.text_anchor, "text_segments", None) or []
-        for seg in segs:
-            start = int(getattr(seg, "start_index", 0) or 0)
-            end = int(getattr(seg, "end_index", 0) or 0)
-            if end > start:
-                parts.append(text[start:end])
-        return "".join(parts).strip()
+    def _prepare(self, image: Image.Image) -> Image.Image:
+        # DocAI reads at most ~300 DPI; larger photos only cost bytes and CPU.
+        if max(image.size) > self.max_side:
+            image = image.copy()
+            image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        return image
+
+    def _img_bytes(self, image: Image.Image, mime: str = "image/jpeg") -> bytes:
+        fmt, opts = _ENCODERS[mime]
+        if fmt == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        buf = io.BytesIO(); image.save(buf, format=fmt, **opts); return buf.getvalue()
 
     def _tables(self, document) -> List[Dict]:
-        tables_out: List[Dict] = []
-        pages = getattr(document, "pages", None) or []
-        for page in pages:
-            tbls = getattr(page, "tables", None) or []
-            for t in tbls:
-                headers: List[str] = []
-                if t.header_rows:
-                    hdr_row = t.header_rows[0]
-                    headers = [self._layout_text(document, cell.layout) for cell in hdr_row.cells]
-                rows: List[List[str]] = []
-                for brow in (t.body_rows or []):
-                    rows.append([self._layout_text(document, cell.layout) for cell in brow.cells])
-                tables_out.append({"headers": headers, "rows": rows})
-        return tables_out
+        return _extract_tables(document.text or "", document.pages)
 
     def _extract_fields_and_tables(self, doc):
         fields: Dict[str, str] = {}
-        ents = getattr(doc, "entities", None) or []
-        if ents:
-            def put(k_raw: str, v: str):
+        # Entities and their properties in document order, as (type, text) pairs.
+        pairs = [(x.type_, x.mention_text) for e in doc.entities for x in (e, *e.properties) if x.type_ and x.mention_text]
+        field_map = self.field_map
+        norm_field_map = self.norm_field_map
+        raw: DefaultDict[str, List[str]] = defaultdict(list)
+        extras: Dict[str, str] = {}
+        for k_raw, v in pairs:
+            # DocAI types are usually the exact identifiers in the field map.
+            canon = field_map.get(k_raw)
+            if not canon:
                 k = _norm(k_raw)
-                if not k or not v: return
-                canon = self.norm_field_map.get(k)
-                val = v.strip()
+                if not k:
+                    continue
+                canon = norm_field_map.get(k)
                 if not canon:
-                    fields.setdefault("_extras", {});
-                    fields["_extras"][k] = val; return
-                existing = fields.get(canon)
-                if not existing:
-                    fields[canon] = val
-                else:
-                    if isinstance(existing, list):
-                        if val not in existing: existing.append(val)
-                    elif val != existing:
-                        fields[canon] = [existing, val]
-            for ent in ents:
-                if getattr(ent, "type_", None) and getattr(ent, "mention_text", None):
-                    put(ent.type_, ent.mention_text)
-                for p in getattr(ent, "properties", None) or []:
-                    if getattr(p, "type_", None) and getattr(p, "mention_text", None):
-                        put(p.type_, p.mention_text)
+                    extras[k] = v.strip()
+                    continue
+            raw[canon].append(v.strip())
+        for canon, vals in raw.items():
+            # blank mentions (unfilled fields) give way to the first real value
+            first = next((i for i, v in enumerate(vals) if v), len(vals) - 1)
+            vals = list(dict.fromkeys(vals[first:]))
+            fields[canon] = vals[0] if len(vals) == 1 else vals
+        if extras:
+            fields["_extras"] = extras
         tables = self._tables(doc)
         return fields, tables
 
+    def _send(self, content: bytes, mime: str):
+        local = self._local
+        if getattr(local, "mime", None) != mime:
+            local.req = _ProcessRequest(
+                name=self.name,
+                raw_document=_RawDocument(mime_type=mime),
+                field_mask=_FIELD_MASK,
+            )
+            local.mime = mime
+        req = local.req
+        req.raw_document.content = content
+        return self.client.process_document(request=req, retry=_RETRY).document
+
+    def _process(self, pil_img: Image.Image):
+        mime = self._mime
+        return self._send(self._img_bytes(self._prepare(pil_img), mime), mime)
+
+    def _extract_one(self, pil_img: Image.Image) -> Tuple[Dict[str, str], List[Dict]]:
+        mime = self._mime
+        content = self._img_bytes(self._prepare(pil_img), mime)
+        if self._cache is None:
+            return self._extract_fields_and_tables(self._send(content, mime))
+        key = (self.name, mime, hashlib.blake2b(content, digest_size=16).digest())
+        with self._cache_lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                self._cache.move_to_end(key)
+                return hit
+        result = self._extract_fields_and_tables(self._send(content, mime))
+        with self._cache_lock:
+            self._cache[key] = result
+            if len(self._cache) > _CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
     def extract(self, pil_img: Image.Image) -> Tuple[Dict[str, str], List[Dict]]:
-        raw = self._img_bytes(pil_img)
-        req = docai.ProcessRequest(
-            name=self.name,
-            raw_document=docai.RawDocument(content=raw, mime_type="image/png"),
-        )
-        result = self.client.process_document(request=req)
-        return self._extract_fields_and_tables(result.document)
+        return self.extract_many([pil_img])[0]
+
+    def extract_many(self, pil_imgs: List[Image.Image], max_workers: int = 8) -> List[Tuple[Dict[str, str], List[Dict]]]:
+        """Run process_document concurrently; results keep the input order."""
+        if len(pil_imgs) <= 1:
+            return [self._extract_one(img) for img in pil_imgs]
+        results: List[Tuple[Dict[str, str], List[Dict]]] = [({}, [])] * len(pil_imgs)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pil_imgs))) as ex:
+            futures = {ex.submit(self._extract_one, img): i for i, img in enumerate(pil_imgs)}
+            for fut in as_completed(futures):
+                results[futures[fut]] = fut.result()
+        return results
+
+    def extract_async(self, pil_img: Image.Image) -> Future:
+        """Start an extract in the background and return its Future.
+        Callers can keep several in flight and collect them as they finish.
+        """
+        ex = self._executor
+        if ex is None:
+            # parsers are shared across sessions; build the pool only once
+            with self._cache_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=8)
+                ex = self._executor
+        return ex.submit(self._extract_one, pil_img)
+
+    def close(self):
+        """Shut down extract_async's pool once its pending extracts finish."""
+        with self._cache_lock:
+            ex, self._executor = self._executor, None
+        if ex is not None:
+            ex.shutdown(wait=True)
 
     def extract_with_text(self, pil_img: Image.Image):
-        raw = self._img_bytes(pil_img)
-        req = docai.ProcessRequest(
-            name=self.name,
-            raw_document=docai.RawDocument(content=raw, mime_type="image/png"),
-        )
-        result = self.client.process_document(request=req)
-        fields, tables = self._extract_fields_and_tables(result.document)
-        fulltext = result.document.text or ""
+        document = self._process(pil_img)
+        fields, tables = self._extract_fields_and_tables(document)
+        fulltext = document.text or ""
         return fields, tables, fulltext
 
+    def batch_extract(self, pil_imgs: List[Image.Image], timeout: float = 900) -> List[Optional[Tuple[Dict[str, str], List[Dict]]]]:
+        """Submit many images in one batch_process_documents call via GCS.
+        Needs DOC_AI_GCS_BUCKET; results come back in input order, with None
+        for documents DocAI failed on. Job objects are deleted afterwards.
+        """
+        from google.cloud import storage
+        bucket_name = os.getenv("DOC_AI_GCS_BUCKET")
+        if not bucket_name:
+            raise RuntimeError("Missing env var DOC_AI_GCS_BUCKET")
+        if not pil_imgs:
+            return []
+        gcs = storage.Client()
+        bucket = gcs.bucket(bucket_name)
+        job = uuid.uuid4().hex
+        mime = self._mime
+        ext = mime.split("/")[1]
+
+        def upload(img: Image.Image) -> str:
+            blob_name = f"docai-in/{job}/{uuid.uuid4().hex}.{ext}"
+            bucket.blob(blob_name).upload_from_string(self._img_bytes(self._prepare(img), mime), content_type=mime)
+            return f"gs://{bucket_name}/{blob_name}"
+
+        try:
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                uris = list(ex.map(upload, pil_imgs))
+            req = docai.BatchProcessRequest(
+                name=self.name,
+                input_documents=docai.BatchDocumentsInputConfig(
+                    gcs_documents=docai.GcsDocuments(
+                        documents=[docai.GcsDocument(gcs_uri=u, mime_type=mime) for u in uris]
+                    )
+                ),
+                document_output_config=docai.DocumentOutputConfig(
+                    gcs_output_config=docai.DocumentOutputConfig.GcsOutputConfig(
+                        gcs_uri=f"gs://{bucket_name}/docai-out/{job}/"
+                    )
+                ),
+            )
+            operation = self.client.batch_process_documents(request=req)
+            operation.result(timeout=timeout)
+            meta = docai.BatchProcessMetadata(operation.metadata)
+            if meta.state != docai.BatchProcessMetadata.State.SUCCEEDED:
+                raise RuntimeError(f"Batch process failed: {meta.state_message}")
+            # a per-document failure leaves status.code non-zero (google.rpc.Code)
+            out_by_input = {s.input_gcs_source: s.output_gcs_destination
+                            for s in meta.individual_process_statuses if not s.status.code}
+
+            def download(uri: str) -> Optional[Tuple[Dict[str, str], List[Dict]]]:
+                dest = out_by_input.get(uri)
+                if not dest:
+                    return None
+                out_bucket, _, prefix = dest[len("gs://"):].partition("/")
+                for blob in gcs.list_blobs(out_bucket, prefix=prefix):
+                    if blob.name.endswith(".json"):
+                        doc = docai.Document.from_json(blob.download_as_bytes(), ignore_unknown_fields=True)
+                        return self._extract_fields_and_tables(doc)
+                return None
+
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                return list(ex.map(download, uris))
+        finally:
+            # ID-card images and extracted fields must not outlive the request
+            for prefix in (f"docai-in/{job}/", f"docai-out/{job}/"):
+                blobs = list(gcs.list_blobs(bucket_name, prefix=prefix))
+                if blobs:
+                    bucket.delete_blobs(blobs, on_error=lambda blob: None)
+
 # ---- Student ID parser ----
 STUDENT_ID_FIELD_MAP = {
     "student_name": "name",
@@ -123,11 +318,15 @@ STUDENT_ID_FIELD_MAP = {
     "bank_card_valid_from": "bank_card_valid_from",
     "bank_card_expiry": "bank_card_expiry",
 }
+STUDENT_ID_NORM_MAP = MappingProxyType({ _norm(k): v for k, v in STUDENT_ID_FIELD_MAP.items() })
 
 class StudentIdParser(BaseDocAIParser):
-    def __init__(self):
-        super().__init__(processor_id_env_var="DOC_AI_PROCESSOR_ID")
-        self.norm_field_map = { _norm(k): v for k, v in STUDENT_ID_FIELD_MAP.items() }
+    __slots__ = ()
+
+    def __init__(self, cache: bool = False):
+        super().__init__(processor_id_env_var="DOC_AI_PROCESSOR_ID", cache=cache)
+        self.field_map = MappingProxyType(STUDENT_ID_FIELD_MAP)
+        self.norm_field_map = STUDENT_ID_NORM_MAP
 
 # ---- Receipt parser (pretrained expense) ----
 RECEIPT_FIELD_MAP = {
@@ -141,8 +340,21 @@ RECEIPT_FIELD_MAP = {
     "receipt_date": "receipt_date",
     "purchase_time": "purchase_time",
 }
+RECEIPT_NORM_MAP = MappingProxyType({ _norm(k): v for k, v in RECEIPT_FIELD_MAP.items() })
 
 class ReceiptParser(BaseDocAIParser):
-    def __init__(self):
-        super().__init__(processor_id_env_var="RECEIPT_PROCESSOR_ID")
-        self.norm_field_map = { _norm(k): v for k, v in RECEIPT_FIELD_MAP.items() }
\ No newline at end of file
+    __slots__ = ()
+
+    def __init__(self, cache: bool = False):
+        super().__init__(processor_id_env_var="RECEIPT_PROCESSOR_ID", cache=cache)
+        self.field_map = MappingProxyType(RECEIPT_FIELD_MAP)
+        self.norm_field_map = RECEIPT_NORM_MAP
+
+# ---- Process-wide parsers (one gRPC channel each) ----
+@functools.lru_cache(maxsize=None)
+def get_student_parser() -> StudentIdParser:
+    return StudentIdParser()
+
+@functools.lru_cache(maxsize=None)
+def get_receipt_parser() -> ReceiptParser:
+    return ReceiptParser()
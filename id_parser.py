@@ -1,7 +1,29 @@
 #id_parser.py
+import functools
 import re
+import string
+import sys
 from typing import Dict, List, Tuple
 
+# Optional RE2 (google-re2 / pyre2): linear-time DFA matching for the
+# whole-text scans. Patterns RE2 rejects (lookaround) stay on stdlib re.
+try:
+    import re2
+except Exception:
+    re2 = None
+
+def _compile(pattern: str, flags: int = 0):
+    if re2 is not None:
+        try:
+            if hasattr(re2, "Options"):  # google-re2 takes an Options object
+                opts = re2.Options()
+                opts.case_sensitive = not flags & re.IGNORECASE
+                return re2.compile(pattern, opts)
+            return re2.compile(pattern, flags)
+        except Exception:
+            pass
+    return re.compile(pattern, flags)
+
 # ---- Label detection ----
 LABEL_MAP: List[Tuple[str, str]] = [
     ("name",      r"name|student\s*name"),
@@ -13,31 +35,72 @@ LABEL_MAP: List[Tuple[str, str]] = [
     ("social",    r"(?:social(?:\s*media)?|socialmedia)"),
     ("address",   r"(?:address|addr)"),
     ("school",    r"(?:school|college|university)"),
-    ("card_type", r"(?:student\s*id\s*card|id\s*card|.*identification\s*card)"),
+    ("card_type", r"(?:student\s*id\s*card|id\s*card|.{0,80}identification\s*card)"),
 ]
 LABEL_RE = {k: re.compile(rf"^\s*(?:{pat})\b\s*: ?\s*", re.IGNORECASE) for k, pat in LABEL_MAP}
-
-BLACKLIST = re.compile(r"\b(getty|istock|shutterstock|depositphotos|adobe\s*stock|pixabay|pexels)\b", re.IGNORECASE)
+# All labels in one alternation; alternatives are tried in LABEL_MAP order.
+# Anchored per line (MULTILINE) with whitespace that never crosses a newline,
+# so one finditer over the joined lines finds every label.
+_H = r"[^\S\n]"
+_LABEL_ALTS = "|".join(f"(?P<{k}>{pat})" for k, pat in LABEL_MAP).replace(r"\s", _H)
+_LABEL_ANY_RE = re.compile(rf"^{_H}*(?:{_LABEL_ALTS})\b{_H}*: ?{_H}*", re.IGNORECASE | re.MULTILINE)
+# Label patterns have no capturing groups of their own, so m.lastindex is the
+# label's position in LABEL_MAP (1-based); keys are interned for the out dict.
+_LABEL_KEYS = (None,) + tuple(sys.intern(k) for k, _ in LABEL_MAP)
+# Every label needs a colon and starts with one of these (card_type aside),
+# so most value lines are rejected before reaching the regex.
+_LABEL_PREFIXES = ("name", "student", "d", "adm", "id", "phone", "tel", "website",
+                   "e", "social", "address", "addr", "school", "college", "university")
+
+def _maybe_label(ln: str) -> bool:
+    if ":" not in ln:
+        return False
+    low = ln.lower()
+    return low.startswith(_LABEL_PREFIXES) or "identification" in low
+
+BLACKLIST = _compile(r"\b(getty|istock|shutterstock|depositphotos|adobe\s*stock|pixabay|pexels)\b", re.IGNORECASE)
+
+# ---- Compiled once; these run per line and per value ----
+_MULTI_WS_RE = re.compile(r"\s{2,}")
+_PHONE_JUNK_RE = re.compile(r"[^\d\-().\s]")
+# One pass each: dash runs collapse to "-", other whitespace runs to " ";
+# runs of 2+ spaces collapse to " ", and a space run before , or . is dropped.
+_PHONE_WS_RE = re.compile(r"\s*-\s*|\s+")
+_SPACES_RE = re.compile(r"(\s{2,}| )(?=[,.])|\s{2,}")
+_WWW_UPPER_RE = re.compile(r"^WWW\b", re.IGNORECASE)
+_WWW_NODOT_RE = re.compile(r"^www(?!\.)")
+_URL_RE = re.compile(r"(?:(https?)://)?([^/\s]+)(/.*)?$")
+_COLON_RE = re.compile(r"\s*:\s*")
+_CARD_RE = re.compile(r"(IDENTIFICATION\s*CARD|ID\s*CARD)", re.IGNORECASE)
+_ASCII_UPPER = frozenset(string.ascii_uppercase)
+_SCHOOL_HDR_RE = re.compile(r"(.*\b(?:SCHOOL|COLLEGE|UNIVERSITY)\b)", re.IGNORECASE)
+_COMMA_RE = re.compile(r",\s*")
+_DOT_RE = re.compile(r"\.(?=\S)")
+_EMAIL_RE = _compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+# Fallback scans run over the whole text, so keep them linear: dots only ever
+# separate labels, and separator runs must be followed by another digit.
+_DOMAIN = r"[A-Za-z0-9\-]+(?:\.[A-Za-z0-9\-]+)*\.[A-Za-z]{2,}(?:/\S*)?"
+_WWW_SITE_RE = _compile(r"(?:https?://)?(?:www\.|WWW\.?)" + _DOMAIN)
+_SITE_RE = re.compile(r"(?:https?://)?(?<![A-Za-z0-9\-])" + _DOMAIN)
+# The lookahead only prunes starts; a hit can still backtrack to a shorter
+# \b, so the 7-character minimum is checked on the match itself.
+_ADM_NO_RE = re.compile(r"\b(?=[0-9][0-9\s\-/.]{6})[0-9](?:[\s\-/.]*[0-9])+\b")
 
 def _clean_spaces(s: str) -> str:
-    s = re.sub(r"\s{2,}", " ", s.strip())
-    s = s.replace(" ,", ",").replace(" .", ".")
-    return s.strip()
+    return _SPACES_RE.sub(lambda m: "" if m.group(1) else " ", s.strip())
 
 def _normalize_phone(s: str) -> str:
-    s = re.sub(r"[^\d\-().\s]", "", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    s = re.sub(r"\s*-\s*", "-", s)
-    return s
+    s = _PHONE_JUNK_RE.sub("", s)
+    return _PHONE_WS_RE.sub(lambda m: "-" if "-" in m.group() else " ", s).strip()
 
 def _normalize_site(s: str) -> str:
     s = s.strip()
-    s = re.sub(r"^WWW\b", "www", s, flags=re.IGNORECASE)
-    s = re.sub(r"^www(?!\.)", "www.", s)
+    s = _WWW_UPPER_RE.sub("www", s)
+    s = _WWW_NODOT_RE.sub("www.", s)
     parts = s.split()
     if len(parts) == 2 and parts[0].lower().startswith("www"):
         s = parts[0] + "." + parts[1].lstrip(".")
-    m = re.match(r"(?:(https?)://)?([^/\s]+)(/.*)?$", s)
+    m = _URL_RE.match(s)
     if m:
         scheme = (m.group(1) or "").lower()
         domain = (m.group(2) or "").lower()
@@ -50,22 +113,32 @@ _DATE_RE = re.compile(
 )
 
 def _is_date(s: str) -> bool:
-    t = s.strip()
-    return bool(_DATE_RE.fullmatch(t) or _DATE_RE.search(t))
+    # a full match is also a search hit, so one search answers both
+    return _DATE_RE.search(s) is not None
+
+
+@functools.lru_cache(maxsize=128)
+def _split_lines(text: str) -> Tuple[str, ...]:
+    # Streamlit reruns re-parse the same OCR text; share the stripped lines.
+    return tuple(ln for ln in map(str.strip, text.splitlines()) if ln)
 
 
 def tidy_text(text: str) -> str:
-    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    lines = _split_lines(text)
     out = []
     i = 0
     while i < len(lines):
         ln = lines[i]
+        if ":" not in ln:
+            out.append(ln)
+            i += 1
+            continue
         if ln == ":" and out:
             nxt = lines[i+1].strip() if i + 1 < len(lines) else ""
             out[-1] = out[-1].rstrip(" :") + " : " + nxt
             i += 2
             continue
-        ln = re.sub(r"\s*:\s*", " : ", ln)
+        ln = _COLON_RE.sub(" : ", ln)
         if out and ln.startswith(":"):
             out[-1] = out[-1].rstrip(" :") + " : " + ln[1:].strip()
         else:
@@ -73,62 +146,61 @@ def tidy_text(text: str) -> str:
         i += 1
     return "\n".join(out)
 
-def _merge_header_school(lines: List[str]) -> str:
-    header = []
-    seen_card = False
-    for ln in lines:
-        if re.search(r"(IDENTIFICATION\s*CARD|ID\s*CARD)", ln, re.IGNORECASE):
-            seen_card = True
-            break
-        if ln.isupper() and re.search(r"[A-Z]", ln):
-            header.append(ln)
-        else:
-            header = []  # reset if interrupted
-    if header:
-        s = " ".join(header).strip()
-        m = re.search(r"(.*\b(?:SCHOOL|COLLEGE|UNIVERSITY)\b)", s, re.IGNORECASE)
-        return m.group(1).strip() if m else s
-    return ""
+def _header_school(header: List[str]) -> str:
+    s = " ".join(header).strip()
+    m = _SCHOOL_HDR_RE.search(s)
+    return m.group(1).strip() if m else s
 
 
 def parse_id_fields(text: str) -> Dict[str, str]:
     out: Dict[str, str] = {}
-    raw_lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
-    lines = [ln for ln in raw_lines if not BLACKLIST.search(ln)]
-    N = len(lines)
-
-    for ln in lines:
-        if re.search(r"(IDENTIFICATION\s*CARD|ID\s*CARD)", ln, re.IGNORECASE):
-            out.setdefault("card_type", "STUDENT ID CARD")
-            break
-    school_hdr = _merge_header_school(lines)
-    if school_hdr:
-        out["school"] = school_hdr
-
+    lines = [ln for ln in _split_lines(text) if not BLACKLIST.search(ln)]
+
+    cleaned = [_clean_spaces(ln) for ln in lines]
+    cand = [i for i, ln in enumerate(cleaned) if _maybe_label(ln)]
+    offsets: Dict[int, int] = {}
+    pos = 0
+    for i in cand:
+        offsets[pos] = i
+        pos += len(cleaned[i]) + 1
+    hits = {offsets[m.start()]: (m, m.start())
+            for m in _LABEL_ANY_RE.finditer("\n".join(cleaned[i] for i in cand))}
     pending: List[str] = []
     values: List[str] = []
-    i = 0
-    while i < N:
-        ln = _clean_spaces(lines[i])
-        matched_key = None
-        for key, rx in LABEL_RE.items():
-            m = rx.match(ln)
-            if m:
-                matched_key = key
-                val = _clean_spaces(ln[m.end():])
-                if val:
-                    if key == "website": val = _normalize_site(val)
-                    if key == "phone":   val = _normalize_phone(val)
-                    if key == "card_type": val = "STUDENT ID CARD" if "card" in val.lower() else val.upper()
-                    out[key] = val
-                else:
-                    pending.append(key)
-                break
-        if not matched_key:
+    # The run of all-caps lines right before the first card line (or at the
+    # end, if there is none) is the school header; labels take precedence.
+    header: List[str] = []
+    seen_card = False
+    for i, ln in enumerate(cleaned):
+        if not seen_card:
+            if _CARD_RE.search(ln):
+                seen_card = True
+                out.setdefault("card_type", "STUDENT ID CARD")
+                if header and "school" not in out:
+                    out["school"] = _header_school(header)
+            elif ln.isupper() and not _ASCII_UPPER.isdisjoint(ln):
+                header.append(lines[i])
+            else:
+                header = []  # reset if interrupted
+        if i in hits:
+            m, pos = hits[i]
+            key = _LABEL_KEYS[m.lastindex]
+            val = _clean_spaces(ln[m.end() - pos:])
+            if val:
+                if key == "website": val = _normalize_site(val)
+                if key == "phone":   val = _normalize_phone(val)
+                if key == "card_type": val = "STUDENT ID CARD" if "card" in val.lower() else val.upper()
+                out[key] = val
+            else:
+                pending.append(key)
+        else:
             values.append(ln)
-        i += 1
 
-    clean_values = [v for v in values if not any(rx.match(v) for rx in LABEL_RE.values()) and v != ":"]
+    if not seen_card and header and "school" not in out:
+        out["school"] = _header_school(header)
+
+    # values only ever holds lines that failed the label match above.
+    clean_values = [v for v in values if v != ":"]
     vi = 0
     for key in pending:
         if vi >= len(clean_values):
@@ -142,9 +214,9 @@ def parse_id_fields(text: str) -> Dict[str, str]:
         elif key == "phone":
             out[key] = _normalize_phone(v)
         elif key == "address":
-            v = re.sub(r",\s*", ", ", v)
-            v = re.sub(r"\.(?=\S)", ". ", v)
-            out[key] = re.sub(r"\s{2,}", " ", v).strip(" .,")
+            v = _COMMA_RE.sub(", ", v)
+            v = _DOT_RE.sub(". ", v)
+            out[key] = _MULTI_WS_RE.sub(" ", v).strip(" .,")
         elif key == "dob":
             if _is_date(v):
                 out[key] = v
@@ -157,24 +229,20 @@ def parse_id_fields(text: str) -> Dict[str, str]:
         vi += 1
 
     blob = " ".join(lines)
+    # One independent search per field: matches for one field must not
+    # consume text another field needs (e.g. a student-number email).
     if "email" not in out:
-        m = re.search(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}", blob)
+        m = _EMAIL_RE.search(blob)
         if m: out["email"] = m.group(0)
     if "website" not in out:
-        m = (
-            re.search(r"(?:https?://)?(?:www\.|WWW)[A-Za-z0-9\-.]+\.[A-Za-z]{2,}(?:/[^\s]*)?", blob)
-            or re.search(r"(?:https?://)?[A-Za-z0-9\-.]+\.[A-Za-z]{2,}(?:/[^\s]*)?", blob)
-        )
+        m = _WWW_SITE_RE.search(blob) or _SITE_RE.search(blob)
         if m: out["website"] = _normalize_site(m.group(0))
     if "dob" not in out:
         m = _DATE_RE.search(blob)
         if m: out["dob"] = m.group(1)
     if "adm_no" not in out:
-        m_id = re.search(r"\b[0-9][0-9\s\-/.]{6,}\b", blob)
-        if m_id:
-            cand = m_id.group(0)
-            if not cand.strip().startswith("+"):
-                out["adm_no"] = cand
+        m = next((m for m in _ADM_NO_RE.finditer(blob) if len(m.group()) >= 7), None)
+        if m: out["adm_no"] = m.group(0)
 
     if "phone" in out:   out["phone"]   = _normalize_phone(out["phone"])
     if "website" in out: out["website"] = _normalize_site(out["website"])
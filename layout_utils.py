@@ -1,30 +1,29 @@
 #layout_utils.py
+from typing import List
+from statistics import median
 import numpy as np
 
-def easyocr_pretty(results):
+def _line_groups(y: np.ndarray, x: np.ndarray, tol: float) -> List[np.ndarray]:
+    """Index arrays per text line, top to bottom, each sorted left to right.
+    A new line starts where consecutive sorted y centers differ by more than tol.
+    """
+    order = np.lexsort((x, y))
+    breaks = np.flatnonzero(np.diff(y[order]) > tol) + 1
+    return [g[np.argsort(x[g], kind="stable")] for g in np.split(order, breaks)]
+
+def easyocr_pretty(results: list) -> str:
     if not results:
         return ""
-    words = []
-    for bbox, text, conf in results:
-        if not str(text).strip():
-            continue
-        xs = [p[0] for p in bbox]; ys = [p[1] for p in bbox]
-        x1, x2, y1, y2 = min(xs), max(xs), min(ys), max(ys)
-        words.append({"t": str(text), "x": x1, "y": (y1+y2)/2.0, "h": (y2-y1) or 1.0})
-    words.sort(key=lambda w: (w["y"], w["x"]))
-    med = float(np.median([w["h"] for w in words])) if words else 1.0
-    tol = med * 0.6
-    lines, cur, last_y = [], [], None
-    for w in words:
-        if last_y is None or abs(w["y"] - last_y) <= tol:
-            cur.append(w)
-        else:
-            lines.append(cur); cur = [w]
-        last_y = w["y"]
-    if cur:
-        lines.append(cur)
-    out = []
-    for line in lines:
-        line.sort(key=lambda w: w["x"])  # left to right
-        out.append(" ".join(w["t"] for w in line))
-    return "\n".join(out)
\ No newline at end of file
+    kept = [(bbox, str(text)) for bbox, text, conf in results if str(text).strip()]
+    if not kept:
+        return ""
+    texts = [t for _, t in kept]
+    boxes = np.asarray([b for b, _ in kept], dtype=np.float64).reshape(len(kept), -1, 2)
+    xs, ys = boxes[:, :, 0], boxes[:, :, 1]
+    x1 = xs.min(axis=1)
+    y1, y2 = ys.min(axis=1), ys.max(axis=1)
+    yc = (y1 + y2) / 2.0
+    h = y2 - y1
+    h[h == 0] = 1.0
+    tol = median(h.tolist()) * 0.6
+    return "\n".join(" ".join(texts[i] for i in g) for g in _line_groups(yc, x1, tol))
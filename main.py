@@ -1,10 +1,10 @@
-import io, base64, os
+import io, base64, hashlib, os
 import streamlit as st
 import numpy as np
 from PIL import Image
-import fitz  # PyMuPDF
 from dotenv import load_dotenv
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # Custom Streamlit component for paste-from-clipboard (optional)
 try:
@@ -12,10 +12,9 @@ try:
 except Exception:
     paste = None
 
-from ocr_utils import OCRUtils
+from ocr_utils import OCRUtils, ResultCache, _text_of, ensure_rgb
 from layout_utils import easyocr_pretty
 from id_parser import tidy_text, parse_id_fields
-from docAI import StudentIdParser, ReceiptParser
 
 load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
 
@@ -33,39 +32,101 @@ docai_mode = st.sidebar.radio(
     help="Choose processor to extract fields."
 )
 
+force_docai_text = st.sidebar.checkbox(
+    "Force DocAI on text pages",
+    help="PDF pages with embedded text only go to DocAI in Receipt mode or when they contain tables."
+)
+
 mode = st.sidebar.radio("Input", ["Upload file(s)", "Paste image"])
 
-ocr = OCRUtils()
+@st.cache_resource(show_spinner=False)
+def get_ocr_utils():
+    return OCRUtils()
+
+ocr = get_ocr_utils()
 
 @st.cache_resource(show_spinner=False)
-def get_reader(lang_set_: str):
-    return ocr.load_reader(lang_set_)
+def get_result_cache():
+    # Disk mirror is opt-in: Cloud Run's filesystem is memory, and entries hold ID-card fields.
+    return ResultCache(os.getenv("OCR_CACHE_DIR"))
 
-reader = get_reader(lang_set)
+results = get_result_cache()
 
-def run_easy(np_img):
-    res = reader.readtext(np_img)
-    raw = "".join([r[1] for r in res]) if res else ""
+def cached(key, fn, *args):
+    hit = results.get(key)
+    return hit if hit is not None else results.put(key, fn(*args))
+
+def easy_texts(res):
+    raw = "".join(map(_text_of, res))
     pretty = easyocr_pretty(res)
     return raw, pretty
 
-def ocr_image_both(pil_img):
-    pil_img = ocr.resize_max(pil_img, max_dim=1600)
+def run_easy(np_img):
+    # Fetched per call so Vision-only sessions never load the model; ocr keeps a
+    # single Reader, so holding one here would pin the old weights on a switch.
+    return easy_texts(ocr.load_reader(lang_set).readtext(np_img))
+
+def render_page(page, max_side=1600, dpi=200):
+    """Rasterise a PDF page, lowering the DPI so the long side fits max_side.
+    The array shares pix.samples with the PIL image (no decode, no copy)."""
+    dpi = min(dpi, int(max_side * 72 / max(page.rect.width, page.rect.height)))
+    pix = page.get_pixmap(dpi=dpi, alpha=False)
+    arr = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, 3)
+    return Image.fromarray(arr), arr
+
+VISION_FORMATS = {"jpeg", "jpg", "png", "webp", "gif", "bmp"}
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _prepared(digest, _pil_img):
+    """OCR-size array, kept across reruns and engine switches (~7 MB each)."""
+    return ocr.resize_max_array(_pil_img, max_dim=1600)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _prepared_jpeg(digest, _pil_img):
+    return ocr.encode(Image.fromarray(_prepared(digest, _pil_img)))
+
+def ocr_image_both(pil_img, digest=None):
+    digest = digest or ResultCache.key(pil_img)
+    return cached(ResultCache.key(digest.encode(), engine, lang_set), _ocr_image, digest, pil_img)
+
+def _ocr_image(digest, pil_img):
     if engine == "Google Vision":
-        raw, pretty = ocr.vision_texts(pil_img, lang_hints=vision_hints)
-        return raw, pretty
-    else:
-        return run_easy(np.array(pil_img))
+        return ocr.vision_texts_bytes(_prepared_jpeg(digest, pil_img), lang_hints=vision_hints)
+    return run_easy(_prepared(digest, pil_img))
+
+def docai_extract(pil_img, digest=None):
+    digest = digest or ResultCache.key(pil_img)
+    return cached(ResultCache.key(digest.encode(), "docai", docai_mode), docai_parser.extract_with_text, pil_img)
+
+def docai_extract_all(pil_imgs, ids=None):
+    """DocAI results for many images: cache hits first, then one batch call
+    (batch_process_documents via GCS when configured) for the rest.
+    ids, if given, stand in for the pixels as cache keys. Failed documents
+    come back as None and are not cached, so a later run retries them."""
+    keys = [ResultCache.key(data, "docai", docai_mode) for data in (ids or pil_imgs)]
+    out = [results.get(k) for k in keys]
+    todo = [n for n, r in enumerate(out) if r is None]
+    if todo:
+        imgs = [pil_imgs[n] for n in todo]
+        if len(imgs) > 1 and os.getenv("DOC_AI_GCS_BUCKET"):
+            found = docai_parser.batch_extract(imgs)
+        else:
+            found = docai_parser.extract_many(imgs)
+        for n, r in zip(todo, found):
+            out[n] = r if r is None else results.put(keys[n], r)
+    return out
 
 docai_parser = None
 if docai_mode == "Student ID":
     try:
-        docai_parser = StudentIdParser()
+        from docAI import get_student_parser  # Document AI SDK loads only when a processor is picked
+        docai_parser = get_student_parser()
     except Exception as e:
         st.warning(f"Student ID Parser (DocAI) not ready: {e}")
 elif docai_mode == "Receipt":
     try:
-        docai_parser = ReceiptParser()
+        from docAI import get_receipt_parser
+        docai_parser = get_receipt_parser()
     except Exception as e:
         st.warning(f"Receipt Parser (DocAI) not ready: {e}")
 
@@ -81,10 +142,29 @@ def display_docai_results(kv_fields, mode_name, regex_fields={}):
 
 
 
-def process_image(pil_img, label="Image"):
-    st.image(pil_img, caption=label, width="stretch")
+@st.cache_data(show_spinner=False, max_entries=256)
+def _has_tables(file_id, page_no, _page):
+    """find_tables walks the page's drawings; run it once per (file, page)."""
+    return bool(_page.find_tables().tables)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _thumbnail_jpeg(key, _pil_img, width):
+    img = _pil_img.copy()
+    img.thumbnail((width, width * 10))
+    buf = io.BytesIO()
+    ensure_rgb(img).save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def thumbnail(pil_img, digest, width=640):
+    """Small JPEG for st.image; the full image is only needed for OCR."""
+    return _thumbnail_jpeg(digest, pil_img, width)
 
-    raw_text, pretty_text = ocr_image_both(pil_img)
+def process_image(pil_img, label="Image", texts=None, docai_result=None, digest=None):
+    # hashed once, shared by every cache below; PDF pages pass their "<file>:<page>" id
+    digest = digest or ResultCache.key(pil_img)
+    st.image(thumbnail(pil_img, digest), caption=label, width="stretch")
+
+    raw_text, pretty_text = texts or ocr_image_both(pil_img, digest)
 
     st.subheader("Text")
     st.text_area("", raw_text or "", height=220)
@@ -98,7 +178,10 @@ def process_image(pil_img, label="Image"):
 
     if docai_parser is not None:
         try:
-            kv_fields, *rest = docai_parser.extract_with_text(pil_img)
+            if docai_result is not None:
+                kv_fields, *rest = docai_result
+            else:
+                kv_fields, *rest = docai_extract(pil_img, digest)
             display_docai_results(kv_fields, docai_mode, regex_fields)
         except Exception as e:
             st.error(f"DocAI error: {e}")
@@ -109,39 +192,77 @@ if mode == "Upload file(s)":
         for f in files:
             st.subheader(f"{f.name}")
             if f.type == "application/pdf":
-                doc = fitz.open(stream=f.read(), filetype="pdf")
+                import fitz  # PyMuPDF; only needed once a PDF shows up
+                pdf_bytes = f.getvalue()
+                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+                # pages are cached as "<sha1 of file>:<page no>", so a re-upload
+                # finds its results without hashing rendered bitmaps
+                file_id = hashlib.sha1(pdf_bytes).hexdigest()
                 all_docai_fields = {}
                 full_text_pages = []
+                docai_pages = []
+                page_images = []
+                image_page_nos = []
+                text_pages = []
                 for i, page in enumerate(doc, 1):
-                    st.caption(f"Page {i}")
                     txt = page.get_text().strip()
                     if txt:
-                        st.text_area(f"Embedded Text (p{i})", txt, height=160)
+                        text_pages.append((i, txt))
                         full_text_pages.append(txt)
+                        # the embedded text already feeds the regex parser; rasterising
+                        # for DocAI only pays off for receipts or tabular pages
                         if docai_parser is not None:
                             try:
-                                pix = page.get_pixmap(dpi=200)
-                                pil_for_docai = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-
-                                kv_fields, *rest = docai_parser.extract_with_text(pil_for_docai)
-                                if kv_fields: all_docai_fields.update(kv_fields)
+                                if force_docai_text or docai_mode == "Receipt" or _has_tables(file_id, i, page):
+                                    pix = page.get_pixmap(dpi=200)
+                                    docai_pages.append((i, Image.frombytes("RGB", [pix.width, pix.height], pix.samples)))
                             except Exception as e:
                                 st.error(f"DocAI error on page {i}: {e}")
                     else:
-                        imgs = page.get_images(full=True)
-                        if not imgs:
-                            st.warning("No images on page.")
-                            continue
-                        for j, im in enumerate(imgs, 1):
-                            xref = im[0]
-                            raw = doc.extract_image(xref)["image"]
-                            pil = Image.open(io.BytesIO(raw)).convert("RGB")
-
+                        pil, arr = render_page(page)
+                        page_images.append((f"Page {i}", pil, arr))
+                        image_page_nos.append(i)
 
-                            process_image(pil, label=f"Page {i} - Image {j}")
-                           
+                # PyMuPDF stays on this thread; the PDF's DocAI work goes out
+                # as one batch in the background while the pages are OCR'd here.
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    docai_future = None
+                    if docai_parser is not None and (docai_pages or page_images):
+                        page_nos = [i for i, _ in docai_pages] + image_page_nos
+                        docai_future = pool.submit(docai_extract_all,
+                                                   [pil for _, pil in docai_pages] + [pil for _, pil, _ in page_images],
+                                                   [f"{file_id}:{i}".encode() for i in page_nos])
+                    # OCR the uncached pages in batches
+                    keys = [ResultCache.key(f"{file_id}:{i}".encode(), engine, lang_set) for i in image_page_nos]
+                    batch_texts = [results.get(k) for k in keys]
+                    todo = [n for n, t in enumerate(batch_texts) if t is None]
+                    if todo and engine == "Google Vision":
+                        # 16 pages per batch_annotate_images call, calls overlapped on asyncio
+                        found = ocr.vision_texts_many([page_images[n][1] for n in todo], vision_hints)
+                        for n, texts in zip(todo, found):
+                            batch_texts[n] = results.put(keys[n], texts)
+                    elif todo:
+                        found = ocr.easyocr_batched(ocr.load_reader(lang_set), [page_images[n][2] for n in todo])
+                        for n, res in zip(todo, found):
+                            batch_texts[n] = results.put(keys[n], easy_texts(res))
 
+                    docai_results = [None] * (len(docai_pages) + len(page_images))
+                    if docai_future is not None:
+                        try:
+                            docai_results = docai_future.result()
+                        except Exception as e:
+                            st.error(f"DocAI batch error: {e}")
+                    for res in docai_results[:len(docai_pages)]:
+                        if res and res[0]: all_docai_fields.update(res[0])
+                    # UI goes out after the work, one collapsed section per page;
+                    # images whose batch result is missing retry one by one in process_image
+                    for i, txt in text_pages:
+                        with st.expander(f"Page {i} - Embedded Text"):
+                            st.text_area(f"Embedded Text (p{i})", txt, height=160)
+                    for i, (label, pil, _), texts, res in zip(image_page_nos, page_images, batch_texts,
+                                                              docai_results[len(docai_pages):]):
+                        with st.expander(label, expanded=len(page_images) == 1):
+                            process_image(pil, label=label, texts=texts, docai_result=res, digest=f"{file_id}:{i}")
 
                 combined = "".join(full_text_pages)
                 if combined and docai_mode != "Receipt":
@@ -153,7 +274,7 @@ if mode == "Upload file(s)":
                     st.subheader("Fields (DocAI merged across pages)")
                     st.json(all_docai_fields)
             else:
-                pil = Image.open(f).convert("RGB")
+                pil = ensure_rgb(Image.open(f))
                 process_image(pil, label=f.name)
 else:
 
@@ -162,9 +283,15 @@ else:
         data = paste(label="📋 Click then Ctrl+V your image", key="paste")
         if data:
             try:
-                _, b64 = data.split(",", 1)
-                pil = Image.open(io.BytesIO(base64.b64decode(b64))).convert("RGB")
-                process_image(pil, label="Pasted Image")
+                header, b64 = data.split(",", 1)
+                content = base64.b64decode(b64)
+                pil = ensure_rgb(Image.open(io.BytesIO(content)))
+                texts = None
+                # Vision takes the pasted file as-is when no resize is needed
+                fmt = header[len("data:image/"):].split(";", 1)[0] if header.startswith("data:image/") else ""
+                if engine == "Google Vision" and fmt in VISION_FORMATS and max(pil.size) <= 1600:
+                    texts = cached(ResultCache.key(content, engine, lang_set), ocr.vision_texts_bytes, content, vision_hints)
+                process_image(pil, label="Pasted Image", texts=texts)
             except Exception as e:
                 st.error(f"Paste decode error: {e}")
     else:
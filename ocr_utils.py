@@ -1,19 +1,141 @@
 #ocr_utils.py
-from typing import List, Optional, Tuple
+from typing import Any, List, Optional, Sequence, Tuple, Union
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+import asyncio
+import functools
+import hashlib
 import io
+import json
+from operator import itemgetter
+import os
+import re
+from statistics import median
+import threading
+import cv2
 import numpy as np
 from PIL import Image
-from google.cloud import vision
-import easyocr
-from layout_utils import easyocr_pretty
+from layout_utils import _line_groups, easyocr_pretty
+
+_text_of = itemgetter(1)  # (bbox, text, conf) -> text
+_CARD_RE = re.compile(r"IDENTIFICATION|ID CARD", re.IGNORECASE)
+
+_NOT_ALPHA = bytes(b for b in range(128) if not chr(b).isalpha()) + bytes(range(128, 256))
+_UPPER = bytes(range(65, 91))
+
+def _is_header(line_text: str) -> bool:
+    # card titles, or lines that are at least 80% capitals (any script)
+    if _CARD_RE.search(line_text):
+        return True
+    if line_text.isascii():  # two bytes.translate passes instead of per-char calls
+        letters = line_text.encode().translate(None, _NOT_ALPHA)
+        upper = len(letters) - len(letters.translate(None, _UPPER))
+        return bool(letters) and upper >= 0.8 * len(letters)
+    letters = "".join(filter(str.isalpha, line_text))
+    return bool(letters) and sum(map(str.isupper, letters)) >= 0.8 * len(letters)
+
+_vision_client = None
+_vision_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=8)
+def _vision_context(lang_hints: Tuple[str, ...]) -> Any:
+    from google.cloud import vision
+    return vision.ImageContext(language_hints=list(lang_hints))
+
+def ensure_rgb(pil_image: Image.Image) -> Image.Image:
+    """convert("RGB") copies even when the image is RGB already; skip that.
+    Transparency is flattened onto white: a plain convert keeps the colour
+    under clear pixels, often black, and dark text turns black-on-black."""
+    if pil_image.mode == "RGB":
+        return pil_image
+    if pil_image.mode in ("RGBA", "LA", "PA") or "transparency" in pil_image.info:
+        rgba = pil_image.convert("RGBA")
+        flat = Image.new("RGB", rgba.size, (255, 255, 255))
+        flat.paste(rgba, mask=rgba.getchannel("A"))
+        return flat
+    return pil_image.convert("RGB")
+
+class ResultCache:
+    """LRU of JSON-able results keyed by content hash. With a directory, it is
+    mirrored to <directory>/<key>.json (also capped at maxsize, oldest first)
+    so app reruns and restarts skip repeated OCR; without one it stays in memory."""
+
+    def __init__(self, directory: Optional[str] = None, maxsize: int = 256) -> None:
+        self.directory = Path(directory) if directory else None
+        self.maxsize = maxsize
+        self._mem: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(data: Union[bytes, Image.Image], *parts: Any) -> str:
+        if isinstance(data, Image.Image):
+            parts = (data.mode, data.size) + parts
+            data = data.tobytes()
+        h = hashlib.sha1(data)
+        h.update(repr(parts).encode())
+        return h.hexdigest()
+
+    def _remember(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._mem[key] = value
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.maxsize:
+                self._mem.popitem(last=False)
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return self._mem[key]
+        if self.directory is None:
+            return None
+        path = self.directory / f"{key}.json"
+        try:
+            value = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)  # mtime doubles as the disk LRU order
+        except (OSError, ValueError):
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str, value: Any) -> Any:
+        self._remember(key, value)
+        if self.directory is None:
+            return value
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = self.directory / f"{key}.{threading.get_ident()}.tmp"
+            tmp.write_text(json.dumps(value, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.directory / f"{key}.json")
+            self._prune()
+        except (OSError, TypeError, ValueError):
+            pass  # disk copy is best effort
+        return value
+
+    def _prune(self) -> None:
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                pass  # removed by another thread
+        if len(entries) <= self.maxsize:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.maxsize]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
 
 class OCRUtils:
-    def __init__(self, languages_vi=("en", "vi"), languages_ja=("en", "ja")):
-        self._reader_vi = None
-        self._reader_ja = None
+    def __init__(self, languages_vi: Sequence[str] = ("en", "vi"), languages_ja: Sequence[str] = ("en", "ja")) -> None:
+        self._reader = None
+        self._reader_langs: List[str] = []
+        self._reader_lock = threading.Lock()
         self.languages_vi = list(languages_vi)
         self.languages_ja = list(languages_ja)
-        self._vision_client = None
 
     @staticmethod
     def resize_max(pil_image: Image.Image, max_dim: int = 1600) -> Image.Image:
@@ -22,35 +144,159 @@ class OCRUtils:
         if m <= max_dim:
             return pil_image
         scale = max_dim / float(m)
-        return pil_image.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-
-    def get_vision_client(self):
-        if self._vision_client is None:
-            self._vision_client = vision.ImageAnnotatorClient()  # ADC on Cloud Run or env creds
-        return self._vision_client
-
-    def load_reader(self, lang_set: str):
-        if lang_set == "vi":
-            if self._reader_vi is None:
-                self._reader_vi = easyocr.Reader(self.languages_vi)
-            return self._reader_vi
-        else:
-            if self._reader_ja is None:
-                self._reader_ja = easyocr.Reader(self.languages_ja)
-            return self._reader_ja
+        size = (int(w * scale), int(h * scale))
+        if pil_image.mode not in ("RGB", "RGBA", "L"):  # palette/CMYK etc. keep PIL
+            return pil_image.resize(size, Image.LANCZOS)
+        # INTER_AREA is the right filter for shrinking and much faster than LANCZOS
+        return Image.fromarray(cv2.resize(np.asarray(pil_image), size, interpolation=cv2.INTER_AREA))
+
+    @classmethod
+    def resize_max_array(cls, pil_image: Image.Image, max_dim: int = 1600) -> np.ndarray:
+        """resize_max straight to the uint8 array EasyOCR reads; an RGB image
+        is shrunk by cv2 without the PIL round trip and its two copies."""
+        w, h = pil_image.size
+        m = max(w, h)
+        if m <= max_dim or pil_image.mode != "RGB":
+            return np.asarray(cls.resize_max(pil_image, max_dim), dtype=np.uint8)
+        scale = max_dim / float(m)
+        return cv2.resize(np.asarray(pil_image), (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def get_vision_client() -> Any:
+        """Process-wide client: one gRPC channel serves every session and thread."""
+        global _vision_client
+        if _vision_client is None:
+            with _vision_lock:
+                if _vision_client is None:
+                    from google.cloud import vision  # gRPC stack loads only once Vision is used
+                    _vision_client = vision.ImageAnnotatorClient()  # ADC on Cloud Run or env creds
+        return _vision_client
 
-    def easyocr_texts(self, reader, np_img) -> Tuple[str, str]:
+    @staticmethod
+    def _new_reader(langs: List[str]) -> Any:
+        import easyocr  # pulls in torch; only when EasyOCR is actually used
+        # EASYOCR_MODELS points at weights baked into the image, so a cold start loads, not downloads
+        reader = easyocr.Reader(langs, cudnn_benchmark=True,
+                                model_storage_directory=os.getenv("EASYOCR_MODELS"))
+        if reader.device != "cpu":
+            # let cuDNN pick its kernels for the batch shape before real work
+            reader.readtext_batched(np.zeros((8, 1600, 1600, 3), np.uint8), batch_size=8)
+        return reader
+
+    def load_reader(self, lang_set: str) -> Any:
+        """The process-wide Reader for lang_set, built on first EasyOCR use.
+
+        vi (latin) and ja need different recognisers and EasyOCR can't mix them,
+        so only one Reader is kept and it is rebuilt when the language set
+        changes. Concurrent sessions on different languages therefore rebuild
+        the model back and forth, and a caller still holding the old Reader
+        keeps its weights alive; fetch it per call rather than storing it."""
+        langs = self.languages_vi if lang_set == "vi" else self.languages_ja
+        with self._reader_lock:  # concurrent sessions must not build two Readers
+            if self._reader is None or self._reader_langs != langs:
+                self._reader = None  # drop our reference so the old weights can go first
+                self._reader = self._new_reader(langs)
+                self._reader_langs = langs
+            return self._reader
+
+    def easyocr_texts(self, reader: Any, np_img: np.ndarray) -> Tuple[str, str]:
         res = reader.readtext(np_img)
-        raw = "\n".join([r[1] for r in res]) if res else ""
+        raw = "\n".join(map(_text_of, res))
         pretty = easyocr_pretty(res)
         return raw, pretty
 
-    def vision_texts(self, pil_image: Image.Image, lang_hints: Optional[List[str]] = None) -> Tuple[str, str]:
-        buf = io.BytesIO(); pil_image.save(buf, format="PNG")
-        vimg = vision.Image(content=buf.getvalue())
-        ctx = vision.ImageContext(language_hints=lang_hints or ["en"])
+    @staticmethod
+    def easyocr_batched(reader: Any, np_imgs: List[np.ndarray], side: int = 1600, batch_size: int = 8) -> List[list]:
+        """readtext results for many images, detected batch_size at a time on GPU.
+        Images are zero-padded (not scaled) onto a side x side canvas, so
+        boxes keep their original coordinates. On CPU batching gains nothing
+        and the padding is extra work, so each image goes through readtext."""
+        if reader.device == "cpu":
+            return [reader.readtext(im) for im in np_imgs]
+        out: List[list] = []
+        for start in range(0, len(np_imgs), batch_size):
+            chunk = np_imgs[start:start + batch_size]
+            canvas = np.zeros((len(chunk), side, side, 3), np.uint8)
+            for k, im in enumerate(chunk):
+                h, w = im.shape[:2]
+                canvas[k, :h, :w] = im[:side, :side]
+            out.extend(reader.readtext_batched(canvas, batch_size=batch_size))
+        return out
+
+    @staticmethod
+    def encode(pil_image: Image.Image, fmt: str = "JPEG") -> bytes:
+        # JPEG q88 is a fraction of the PNG payload and reads the same; pass fmt="PNG" for line art
+        buf = io.BytesIO()
+        if fmt == "JPEG" and (pil_image.mode in ("RGBA", "LA", "PA") or "transparency" in pil_image.info):
+            fmt = "PNG"  # flattening alpha to JPEG can turn dark text on clear backgrounds black-on-black
+        if fmt == "JPEG":
+            if pil_image.mode not in ("RGB", "L"):
+                pil_image = pil_image.convert("RGB")
+            pil_image.save(buf, format="JPEG", quality=88, optimize=False, progressive=False)
+        else:
+            pil_image.save(buf, format=fmt)
+        return buf.getvalue()
+
+    def vision_texts(self, pil_image: Image.Image, lang_hints: Optional[List[str]] = None, fmt: str = "JPEG") -> Tuple[str, str]:
+        return self.vision_texts_bytes(self.encode(pil_image, fmt), lang_hints)
+
+    def vision_texts_bytes(self, content: bytes, lang_hints: Optional[List[str]] = None) -> Tuple[str, str]:
+        """Same as vision_texts for already-encoded image bytes (no re-encode)."""
+        from google.cloud import vision
+        vimg = vision.Image(content=content)
+        ctx = _vision_context(tuple(lang_hints or ["en"]))
         client = self.get_vision_client()
         resp = client.document_text_detection(image=vimg, image_context=ctx)
+        return self._vision_result(resp)
+
+    @classmethod
+    def _vision_requests(cls, pil_images: List[Image.Image], lang_hints: Optional[List[str]], fmt: str) -> list:
+        from google.cloud import vision
+        ctx = _vision_context(tuple(lang_hints or ["en"]))
+        feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+        return [vision.AnnotateImageRequest(image=vision.Image(content=cls.encode(img, fmt)),
+                                            features=[feature], image_context=ctx)
+                for img in pil_images]
+
+    def vision_texts_batch(self, pil_images: List[Image.Image], lang_hints: Optional[List[str]] = None,
+                           fmt: str = "JPEG") -> List[Tuple[str, str]]:
+        """vision_texts for many images, 16 per batch_annotate_images call (the API limit)."""
+        client = self.get_vision_client()
+        out: List[Tuple[str, str]] = []
+        for start in range(0, len(pil_images), 16):
+            batch = client.batch_annotate_images(requests=self._vision_requests(pil_images[start:start + 16], lang_hints, fmt))
+            out.extend(self._vision_result(resp) for resp in batch.responses)
+        return out
+
+    async def _vision_batches_async(self, chunks: List[List[Image.Image]], lang_hints: Optional[List[str]],
+                                    fmt: str, concurrency: int) -> List[List[Tuple[str, str]]]:
+        from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
+        from google.api_core.retry import if_exception_type
+        from google.api_core.retry_async import AsyncRetry
+        from google.cloud import vision
+        retry = AsyncRetry(predicate=if_exception_type(ResourceExhausted, ServiceUnavailable),
+                           initial=1.0, maximum=32.0, multiplier=2.0)
+        sem = asyncio.Semaphore(concurrency)
+        # async channels belong to one event loop, so the client lives only for
+        # this run and its channel is closed before asyncio.run tears the loop down
+        async with vision.ImageAnnotatorAsyncClient() as client:
+            async def run(chunk: List[Image.Image]) -> List[Tuple[str, str]]:
+                async with sem:
+                    batch = await client.batch_annotate_images(
+                        requests=self._vision_requests(chunk, lang_hints, fmt), retry=retry)
+                return [self._vision_result(resp) for resp in batch.responses]
+
+            return await asyncio.gather(*(run(c) for c in chunks))
+
+    def vision_texts_many(self, pil_images: List[Image.Image], lang_hints: Optional[List[str]] = None,
+                          fmt: str = "JPEG", concurrency: int = 8) -> List[Tuple[str, str]]:
+        """vision_texts_batch with the 16-image calls in flight together
+        (at most `concurrency` at once), backing off on quota errors."""
+        chunks = [pil_images[k:k + 16] for k in range(0, len(pil_images), 16)]
+        done = asyncio.run(self._vision_batches_async(chunks, lang_hints, fmt, concurrency))
+        return [texts for chunk in done for texts in chunk]
+
+    def _vision_result(self, resp: Any) -> Tuple[str, str]:
         if resp.error and resp.error.message:
             raise RuntimeError(f"Vision OCR error: {resp.error.message}")
         raw = ""
@@ -60,75 +306,59 @@ class OCRUtils:
             raw = resp.text_annotations[0].description or ""
         pretty = self._vision_lines_with_gutter(resp.full_text_annotation) if resp.full_text_annotation else raw
         return raw, pretty
-    def _vision_lines_with_gutter(self, annotation) -> str:
-        import numpy as np
-        words = []
-        colon_x = []
+
+    def _vision_lines_with_gutter(self, annotation: Any) -> str:
+        # one pass over the protobuf; boxes go into a flat x1,x2,y1,y2 buffer
+        tokens: List[str] = []
+        boxes = array("d")
         for page in getattr(annotation, "pages", []):
             for block in getattr(page, "blocks", []):
                 for para in getattr(block, "paragraphs", []):
                     for w in getattr(para, "words", []):
                         token = "".join(s.text for s in getattr(w, "symbols", []) or []) or ""
-                        xs = [v.x for v in w.bounding_box.vertices if v.x is not None]
-                        ys = [v.y for v in w.bounding_box.vertices if v.y is not None]
-                        if not token.strip() or not xs or not ys:
+                        verts = w.bounding_box.vertices
+                        if not token.strip() or not verts:
                             continue
-                        x1, x2 = min(xs), max(xs)
-                        y1, y2 = min(ys), max(ys)
-                        cy = (y1 + y2) / 2.0
-                        h = (y2 - y1) or 1.0
-                        words.append({"t": token, "x1": x1, "x2": x2, "y": cy, "h": h})
-                        if token == ":":
-                            colon_x.append((x1 + x2) / 2.0)
-        if not words:
+                        if len(verts) == 4:  # word boxes are quads; proto3 ints are never None
+                            a, b, c, d = verts
+                            xs = (a.x, b.x, c.x, d.x)
+                            ys = (a.y, b.y, c.y, d.y)
+                        else:
+                            xs = [v.x for v in verts if v.x is not None]
+                            ys = [v.y for v in verts if v.y is not None]
+                            if not xs or not ys:
+                                continue
+                        tokens.append(token)
+                        boxes.extend((min(xs), max(xs), min(ys), max(ys)))
+        if not tokens:
             return ""
-        words.sort(key=lambda w: (w["y"], w["x1"]))
-        med_h = float(np.median([w["h"] for w in words])) or 1.0
-        tol = med_h * 0.6
-        lines, cur, last_y = [], [], None
-        for w in words:
-            if last_y is None or abs(w["y"] - last_y) <= tol:
-                cur.append(w)
-            else:
-                lines.append(cur); cur = [w]
-            last_y = w["y"]
-        if cur: lines.append(cur)
-        if colon_x:
-            gutter = float(np.median(colon_x))
+        x1, x2, y1, y2 = np.frombuffer(boxes, dtype=np.float64).reshape(-1, 4).T
+        y = (y1 + y2) / 2.0
+        h = y2 - y1
+        h[h == 0] = 1.0
+        tol = (median(h.tolist()) or 1.0) * 0.6
+        lines = _line_groups(y, x1, tol)
+        colon = np.fromiter((t == ":" for t in tokens), dtype=bool, count=len(tokens))
+        if colon.any():
+            gutter = median(((x1[colon] + x2[colon]) / 2.0).tolist())
         else:
-            mids = []
-            for ln in lines:
-                xs = sorted([(w["x1"] + w["x2"]) / 2.0 for w in ln])
-                if xs:
-                    mids.append(xs[len(xs)//2])
-            gutter = float(np.median(mids)) if mids else None
+            mid = (x1 + x2) / 2.0
+            gutter = median([sorted(mid[g].tolist())[len(g) // 2] for g in lines])
         out_lines = []
         carry_label = ""
-        def is_header(line_text: str) -> bool:
-            s = line_text.strip()
-            if ("IDENTIFICATION" in s.upper()) or ("ID CARD" in s.upper()):
-                return True
-            letters = [ch for ch in s if ch.isalpha()]
-            return bool(letters) and (sum(1 for ch in letters if ch.isupper()) / len(letters) >= 0.8)
-        for ln in lines:
-            ln.sort(key=lambda w: w["x1"])
-            raw = " ".join(w["t"] for w in ln).strip()
-            if is_header(raw):
+        for g in lines:
+            raw = " ".join([tokens[k] for k in g]).strip()
+            if _is_header(raw):
                 out_lines.append(raw)
                 carry_label = ""
                 continue
-            if gutter is None:
-                out_lines.append(raw)
-                continue
-            left = [w for w in ln if w["x2"] <= gutter]
-            right = [w for w in ln if w["x1"] > gutter]
-            left_text  = " ".join(w["t"] for w in left).strip()
-            right_text = " ".join(w["t"] for w in right).strip()
+            left_text  = " ".join([tokens[k] for k in g[x2[g] <= gutter]]).strip()
+            right_text = " ".join([tokens[k] for k in g[x1[g] > gutter]]).strip()
             if left_text == ":": left_text = ""
             if right_text == ":": right_text = ""
             if left_text and right_text:
                 carry_label = ""
-                if "IDENTIFICATION" in right_text.upper() or "ID CARD" in right_text.upper():
+                if _CARD_RE.search(right_text):
                     out_lines.append(left_text + " " + right_text)
                 else:
                     out_lines.append(f"{left_text} : {right_text}")
@@ -1,20 +1,18 @@
 from dotenv import load_dotenv
-from docAI import DocAIKV
 # Custom Streamlit component for paste-from-clipboard
 from st_img_pastebutton import paste
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 # Import OCR utilities and field extractors
 # main.py
 import io, base64, os
 import streamlit as st
-import numpy as np
 from PIL import Image
-import fitz  # PyMuPDF
 load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
 import os
 print("DOC_AI_LOCATION =", os.getenv("DOC_AI_LOCATION"))
 print("DOC_AI_PROCESSOR_ID =", os.getenv("DOC_AI_PROCESSOR_ID"))
-from ocr_utils import OCRUtils
+from ocr_utils import OCRUtils, _text_of, ensure_rgb
 from layout_utils import easyocr_pretty
 from id_parser import tidy_text, parse_id_fields
 
@@ -30,34 +28,60 @@ docai_kv = None
 use_docai = st.sidebar.checkbox("Extract fields with Document AI (KV/Tables)")
 if use_docai:
     try:
-        docai_kv = DocAIKV()   # uses env vars DOC_AI_LOCATION, DOC_AI_PROCESSOR_ID
+        from docAI import get_student_parser  # same cached parser main.py uses
+        docai_kv = get_student_parser()   # uses env vars DOC_AI_LOCATION, DOC_AI_PROCESSOR_ID
     except Exception as e:
         st.warning(f"Document AI not available: {e}")
         docai_kv = None
-ocr = OCRUtils()
 
 @st.cache_resource(show_spinner=False)
-def get_reader(lang_set_: str):
-    return ocr.load_reader(lang_set_)
+def get_ocr_utils():
+    return OCRUtils()
 
-reader = get_reader(lang_set)
+ocr = get_ocr_utils()
+
+@st.cache_resource(show_spinner=False)
+def get_pool():
+    # Vision and DocAI are both network round-trips; run them side by side.
+    # Cached so Streamlit reruns reuse the threads.
+    return ThreadPoolExecutor(max_workers=4)
 
 def run_easy(np_img):
-    res = reader.readtext(np_img)
-    return "\n".join([r[1] for r in res]) if res else "", easyocr_pretty(res)
+    # Fetched per call so Vision-only sessions never load the model; ocr keeps a
+    # single Reader, so holding one here would pin the old weights on a switch.
+    res = ocr.load_reader(lang_set).readtext(np_img)
+    return "\n".join(map(_text_of, res)), easyocr_pretty(res)
+
+VISION_FORMATS = {"JPEG", "PNG", "WEBP", "GIF", "BMP"}
 
-def ocr_image(pil_img):
-    pil_img = ocr.resize_max(pil_img, max_dim=1600)
+def ocr_image(pil_img, raw=None, fmt=None):
     if engine == "Google Vision":
         try:
-            return ocr.vision_ocr(pil_img, lang_hints=vision_hints)
+            # Vision reads the original file when it needs no downscale
+            if raw is not None and fmt in VISION_FORMATS and max(pil_img.size) <= 1600:
+                return ocr.vision_texts_bytes(raw, lang_hints=vision_hints)[1]
+            return ocr.vision_texts(ocr.resize_max(pil_img, max_dim=1600), lang_hints=vision_hints)[1]
         except Exception as e:
             st.error(f"Vision error: {e}")
             return ""
     else:
-        _, pretty = run_easy(np.array(pil_img))
+        _, pretty = run_easy(ocr.resize_max_array(pil_img, max_dim=1600))
         return pretty
 
+def render_page(page, max_side=1600, dpi=200):
+    # Rasterise the whole page (scans and vector-only pages alike); no image decode.
+    dpi = min(dpi, int(max_side * 72 / max(page.rect.width, page.rect.height)))
+    pix = page.get_pixmap(dpi=dpi, alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+def ocr_images(pil_imgs):
+    # On GPU EasyOCR detects several pages per forward pass; on CPU, or for a
+    # lone image, plain readtext is faster.
+    if engine == "Google Vision" or len(pil_imgs) < 2 or ocr.load_reader(lang_set).device == "cpu":
+        return [ocr_image(p) for p in pil_imgs]
+    arrs = [ocr.resize_max_array(p, max_dim=1600) for p in pil_imgs]
+    return [easyocr_pretty(res) for res in ocr.easyocr_batched(ocr.load_reader(lang_set), arrs)]
+
 mode = st.sidebar.radio("Input", ["Upload file(s)", "Paste image"])
 if mode == "Upload file(s)":
     files = st.file_uploader("Upload image(s) or PDF(s)", type=["jpg","jpeg","png","webp","pdf"], accept_multiple_files=True)
@@ -65,27 +89,24 @@ if mode == "Upload file(s)":
         for f in files:
             st.subheader(f.name)
             if f.type == "application/pdf":
+                import fitz  # PyMuPDF; only needed once a PDF shows up
                 doc = fitz.open(stream=f.read(), filetype="pdf")
                 full_text = []
+                crops = []  # (tag, page image, slot in full_text), OCR'd together after the loop
                 for i, page in enumerate(doc, 1):
                     st.caption(f"Page {i}")
                     txt = page.get_text().strip()
                     if not txt:
-                        imgs = page.get_images(full=True)
-                        if not imgs:
-                            st.warning("No images on page.")
-                            continue
-                        for j, im in enumerate(imgs, 1):
-                            xref = im[0]
-                            raw = doc.extract_image(xref)["image"]
-                            pil = Image.open(io.BytesIO(raw)).convert("RGB")
-                            st.image(pil, caption=f"Page {i} - Image {j}", width="stretch")
-                            page_text = ocr_image(pil)
-                            full_text.append(page_text)
-                            st.text_area(f"OCR Text (p{i}-img{j})", page_text, height=140)
+                        pil = render_page(page)
+                        st.image(pil, caption=f"Page {i}", width="stretch")
+                        crops.append((f"p{i}", pil, len(full_text)))
+                        full_text.append("")
                     else:
                         st.text_area(f"Embedded Text (p{i})", txt, height=140)
                         full_text.append(txt)
+                for (tag, _, slot), page_text in zip(crops, ocr_images([c[1] for c in crops])):
+                    full_text[slot] = page_text
+                    st.text_area(f"OCR Text ({tag})", page_text, height=140)
                 combined = tidy_text("\n\n".join(full_text))
                 if combined:
                     st.download_button("Download text", data=combined, file_name="pdf_ocr.txt", mime="text/plain")
@@ -110,10 +131,12 @@ if mode == "Upload file(s)":
                         except Exception as e:
                             st.error(f"DocAI error: {e}")
             else:
-                pil = Image.open(f).convert("RGB")
+                src = Image.open(f)
+                pil = ensure_rgb(src)
                 st.image(pil, caption=f.name, width="stretch")
                 if st.button(f"Extract: {f.name}"):
-                    text = ocr_image(pil)
+                    docai_future = get_pool().submit(docai_kv.extract, pil) if use_docai and docai_kv is not None and engine == "Google Vision" else None
+                    text = ocr_image(pil, raw=f.getvalue(), fmt=src.format)
                     cleaned = tidy_text(text)
                     fields = parse_id_fields(cleaned)
                     st.text_area("Text", cleaned, height=220)
@@ -122,7 +145,7 @@ if mode == "Upload file(s)":
                     st.download_button("Download text", data=cleaned, file_name=f"{os.path.splitext(f.name)[0]}_ocr.txt", mime="text/plain")
                     if use_docai and docai_kv is not None:
                         try:
-                            kv_fields, tables = docai_kv.extract(pil)
+                            kv_fields, tables = docai_future.result() if docai_future else docai_kv.extract(pil)
                             if kv_fields:
                                 st.subheader("Fields (Document AI)")
                                 st.json(kv_fields)
@@ -146,10 +169,13 @@ else:
     data = paste(label="📋 Click then Ctrl+V your image", key="paste")
     if data:
         _, b64 = data.split(",", 1)
-        pil = Image.open(io.BytesIO(base64.b64decode(b64))).convert("RGB")
+        raw = base64.b64decode(b64)
+        src = Image.open(io.BytesIO(raw))
+        pil = ensure_rgb(src)
         st.image(pil, caption="Pasted Image", width="auto")
         if st.button("Extract"):
-            text = ocr_image(pil)
+            docai_future = get_pool().submit(docai_kv.extract, pil) if use_docai and docai_kv is not None and engine == "Google Vision" else None
+            text = ocr_image(pil, raw=raw, fmt=src.format)
             cleaned = tidy_text(text)
             fields = parse_id_fields(cleaned)
             st.text_area("Text", cleaned, height=220)
@@ -158,7 +184,7 @@ else:
             st.download_button("Download text", data=cleaned, file_name="pasted_ocr.txt", mime="text/plain")
             if use_docai and docai_kv is not None:
                 try:
-                    kv_fields, tables = docai_kv.extract(pil)
+                    kv_fields, tables = docai_future.result() if docai_future else docai_kv.extract(pil)
                     if kv_fields:
                         st.subheader("Fields (Document AI)")
                         st.json(kv_fields)
@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import pytest
+
+docAI = pytest.importorskip("docAI")
+
+
+def _doc(*pairs):
+    ents = [SimpleNamespace(type_=k, mention_text=v, properties=[]) for k, v in pairs]
+    return SimpleNamespace(entities=ents, text="", pages=[])
+
+
+def _parser():
+    p = object.__new__(docAI.StudentIdParser)
+    p.field_map = {"name": "name"}
+    p.norm_field_map = {"name": "name"}
+    return p
+
+
+def test_blank_mention_does_not_shadow_value():
+    fields, _ = _parser()._extract_fields_and_tables(_doc(("name", "  "), ("name", "A")))
+    assert fields["name"] == "A"
+
+
+def test_all_blank_mentions_keep_empty_field():
+    fields, _ = _parser()._extract_fields_and_tables(_doc(("name", " "), ("name", " ")))
+    assert fields["name"] == ""
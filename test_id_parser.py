@@ -0,0 +1,16 @@
+from id_parser import parse_id_fields
+
+
+def test_fallback_keeps_student_number_email():
+    out = parse_id_fields("NGUYEN VAN A\nMSSV 20190001\n20190001@student.hust.edu.vn")
+    assert out["email"] == "20190001@student.hust.edu.vn"
+
+
+def test_fallback_fields_do_not_consume_each_other():
+    assert parse_id_fields("tel:123\n99.99.99.99a@b.co")["email"] == "99.99.99.99a@b.co"
+    assert parse_id_fields("Websitewww.school.edu")["website"] == "www.school.edu"
+
+
+def test_adm_no_fallback_needs_seven_characters():
+    assert "adm_no" not in parse_id_fields("DOB 12/05/2001Male")
+    assert parse_id_fields("DOB 12/05/2001Male 2023 1145")["adm_no"] == "2023 1145"